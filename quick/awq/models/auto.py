@@ -77,6 +77,8 @@ class AutoAWQForCausalLM:
         device_map="balanced",
         offload_folder=None,
         use_quick=False,
+        fuse_layers=True,
+        horizontal_fusion=True,
         **config_kwargs,
     ) -> BaseAWQForCausalLM:
         os.environ["AWQ_BATCH_SIZE"] = str(batch_size)
@@ -88,7 +90,10 @@ class AutoAWQForCausalLM:
             quant_filename,
             max_new_tokens,
             trust_remote_code=trust_remote_code,
-            fuse_layers=True,
+            # horizontal_fusion only applies when fuse_layers is off or the
+            # model has no fused blocks, fused blocks fuse QKV themselves
+            fuse_layers=fuse_layers,
+            horizontal_fusion=horizontal_fusion,
             use_exllama=use_exllama,
             use_exllama_v2=use_exllama_v2,
             safetensors=safetensors,
@@ -6,10 +6,12 @@ import transformers
 import torch.nn as nn
 
 from tqdm import tqdm
+from pathlib import Path
 from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
 from safetensors.torch import save_file
 from huggingface_hub import snapshot_download
-from transformers.modeling_utils import shard_checkpoint
+from transformers.utils.hub import convert_file_size_to_int
 
 from quick.awq.modules.linear.quick import WQLinear_QUICK
 from quick.awq.modules.linear.gemm import WQLinear_GEMM
@@ -37,9 +39,10 @@ from quick.awq.models._config import AwqConfig
 from quick.awq.modules.act import ScaledActivation
 from quick.awq.quantize.quantizer import AwqQuantizer
 from quick.awq.utils.module import get_named_linears, set_op_by_name
-from quick.awq.utils.fused_utils import get_attention_shapes
+from quick.awq.utils.fused_utils import get_attention_shapes, fuse_linears, fuse_qkv_linear
 from quick.awq.modules.fused.cache import WindowedCache
 from quick.awq.modules.fused.attn import RoPE, ALiBi
+from quick.awq.modules.fused.linear import split_fused_linear
 from quick.awq.quantize.quantizer import QuantAttentionFused
 
 # Since we support different `AutoModelForxxx` from transformers
@@ -64,6 +67,35 @@ TRANSFORMERS_AUTO_MAPPING_DICT = {
     "llava": "AutoModelForVision2Seq",
 }
 
+# (version, use_exllama, use_exllama_v2) -> WQLinear implementation,
+# exllama kernels load the GEMM checkpoint format
+WQLINEAR_MODULES = {
+    ("QUICK", False, False): WQLinear_QUICK,
+    ("GEMM", False, False): WQLinear_GEMM,
+    ("GEMV", False, False): WQLinear_GEMV,
+    ("GEMM", True, False): WQLinear_Exllama,
+    ("GEMM", False, True): WQLinear_ExllamaV2,
+}
+
+# Split-k launch parameters of the QUICK kernel per SM architecture,
+# other architectures keep the WQLinear_QUICK.from_linear defaults
+QUICK_K_SPLITS = {
+    (8, 0): dict(k_split_1=16, k_split_2=16),
+    (9, 0): dict(k_split_1=32, k_split_2=16),
+}
+
+# Shards are copied to host memory by the writer threads, so cap how many are
+# in flight: at most MAX_SHARD_WRITERS and within the memory of one 10GB shard
+MAX_SHARD_WRITERS = 4
+SAVE_HOST_MEMORY_BUDGET = "10GB"
+
+# Linears that consume the same input and can be horizontally fused into
+# a single quantized GEMM: (parent module, fused name, linear names)
+HORIZONTAL_FUSION_GROUPS = [
+    ("self_attn", "qkv_proj", ["q_proj", "k_proj", "v_proj"]),
+    ("mlp", "gate_up_proj", ["gate_proj", "up_proj"]),
+]
+
 
 class BaseAWQForCausalLM(nn.Module):
     def __init__(
@@ -100,7 +132,10 @@ class BaseAWQForCausalLM(nn.Module):
         modules_to_not_convert=None,
         export_compatible=False,
     ):
-        self.quant_config: AwqConfig = AwqConfig.from_dict(quant_config)
+        if isinstance(quant_config, AwqConfig):
+            self.quant_config: AwqConfig = quant_config
+        else:
+            self.quant_config: AwqConfig = AwqConfig.from_dict(quant_config)
 
         self.quantizer = AwqQuantizer(
             self,
@@ -141,58 +176,123 @@ class BaseAWQForCausalLM(nn.Module):
     def fuse_layers(model):
         pass
 
-    def save_quantized(self, save_dir, safetensors=True, shard_size="10GB"):
-        save_dir = save_dir[:-1] if save_dir[-1] == "/" else save_dir
-
-        # Save model
-        class EmptyModule(nn.Module):
-            def __init__(self):
-                super(EmptyModule, self).__init__()
-
-            def forward(self, x):
-                return x
+    def save_quantized(self, save_dir, safetensors=True, shard_size="auto"):
+        save_dir = Path(save_dir)
 
         # Save model and config files with empty state dict
         self.model.config.quantization_config = self.quant_config.to_transformers_dict()
-        self.model.save_pretrained(save_dir, state_dict=EmptyModule().state_dict())
+        self.model.save_pretrained(save_dir, state_dict={}, safe_serialization=False)
         self.quant_config.save_pretrained(save_dir)
 
         # Vision transformers have a processor
         if self.processor is not None:
             self.processor.save_pretrained(save_dir)
 
-        # Remove empty state dict
-        default_paths = [
-            f"{save_dir}/model.safetensors",
-            f"{save_dir}/pytorch_model.bin",
-        ]
-        for path in default_paths:
-            if os.path.exists(path):
-                os.remove(path)
+        # Remove the empty state dict and weights left by an earlier save into
+        # the same directory, stale shards would otherwise be loaded as well
+        for pattern in [
+            "model*.safetensors",
+            "model.safetensors.index.json",
+            "pytorch_model*.bin",
+            "pytorch_model.bin.index.json",
+        ]:
+            for path in save_dir.glob(pattern):
+                path.unlink(missing_ok=True)
 
         # model_name has no extension, add it when saving state_dict
         model_name = "model.safetensors" if safetensors else "pytorch_model.bin"
 
-        # shard checkpoint into chunks (10GB default)
-        shards, index = shard_checkpoint(
-            self.model.state_dict(), max_shard_size=shard_size, weights_name=model_name
-        )
+        # shard checkpoint into chunks, state_dict only holds references
+        # so tensors are copied to host memory shard by shard
+        state_dict = self.model.state_dict()
+        total_size = sum(v.numel() * v.element_size() for v in state_dict.values())
 
-        for shard_file, shard in shards.items():
-            if safetensors:
-                # safetensors must be in the same memory, so we duplicate and use contiguous memory
-                shard = {k: v.clone().contiguous() for k, v in shard.items()}
-                save_file(
-                    shard, os.path.join(save_dir, shard_file), metadata={"format": "pt"}
+        if shard_size == "auto":
+            # split the host memory budget between the writer threads
+            max_shard_size = (
+                convert_file_size_to_int(SAVE_HOST_MEMORY_BUDGET) // MAX_SHARD_WRITERS
+            )
+        else:
+            max_shard_size = convert_file_size_to_int(shard_size)
+
+        shards = self._split_into_shards(state_dict, max_shard_size)
+
+        if len(shards) == 1:
+            shard_files = [model_name]
+        else:
+            name, ext = os.path.splitext(model_name)
+            shard_files = [
+                f"{name}-{i + 1:05d}-of-{len(shards):05d}{ext}" for i in range(len(shards))
+            ]
+
+        # write shards concurrently, serialization of a single shard is single threaded
+        max_workers = max(1, min(
+            len(shards),
+            MAX_SHARD_WRITERS,
+            convert_file_size_to_int(SAVE_HOST_MEMORY_BUDGET) // max_shard_size,
+        ))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    self._save_shard,
+                    {k: state_dict[k] for k in shard},
+                    save_dir.joinpath(shard_file),
+                    safetensors,
                 )
-            else:
-                torch.save(shard, os.path.join(save_dir, shard_file))
+                for shard_file, shard in zip(shard_files, shards)
+            ]
+            for future in futures:
+                future.result()
 
         # save shard index
-        if index is not None:
-            with open(f"{save_dir}/{model_name}.index.json", "w+") as file:
+        if len(shards) > 1:
+            index = {
+                "metadata": {"total_size": total_size},
+                "weight_map": {
+                    k: shard_file
+                    for shard_file, shard in zip(shard_files, shards)
+                    for k in shard
+                },
+            }
+            with open(save_dir.joinpath(f"{model_name}.index.json"), "w+") as file:
                 file.write(json.dumps(index, indent=4))
 
+    @staticmethod
+    def _split_into_shards(state_dict, max_shard_size):
+        # group tensor names into shards of at most max_shard_size bytes,
+        # a single tensor larger than that gets a shard of its own
+        shards = [[]]
+        current_size = 0
+        for k, v in state_dict.items():
+            tensor_size = v.numel() * v.element_size()
+            if shards[-1] and current_size + tensor_size > max_shard_size:
+                shards.append([])
+                current_size = 0
+            shards[-1].append(k)
+            current_size += tensor_size
+
+        return shards
+
+    @staticmethod
+    def _save_shard(shard, path, safetensors):
+        # only this shard is copied to host memory
+        shard = {k: v.detach().to("cpu") for k, v in shard.items()}
+
+        if safetensors:
+            # safetensors rejects tensors sharing memory, so only duplicate those
+            # and make the rest contiguous (a no-op when they already are)
+            storages = set()
+            contiguous_shard = {}
+            for k, v in shard.items():
+                storage_ptr = v.untyped_storage().data_ptr()
+                if storage_ptr in storages:
+                    v = v.clone()
+                storages.add(storage_ptr)
+                contiguous_shard[k] = v.contiguous()
+            save_file(contiguous_shard, path, metadata={"format": "pt"})
+        else:
+            torch.save(shard, path)
+
     @classmethod
     def from_pretrained(
         self,
@@ -250,6 +350,7 @@ class BaseAWQForCausalLM(nn.Module):
         safetensors=True,
         is_quantized=True,
         fuse_layers=False,
+        horizontal_fusion=True,
         use_exllama=False,
         use_exllama_v2=False,
         version="GEMM",
@@ -293,8 +394,8 @@ class BaseAWQForCausalLM(nn.Module):
         model.tie_weights()
 
         if quant_config.version == "QUICK":
-            for i in range(len(model.model.layers)): 
-                del model.model.layers[i].self_attn.rope
+            for layer in model.model.layers:
+                delattr(layer.self_attn, "rope")
         
         # loads the weights into modules and distributes
         # across available devices automatically
@@ -306,6 +407,24 @@ class BaseAWQForCausalLM(nn.Module):
             offload_folder=offload_folder,
             dtype=torch_dtype,
         )
+        offloaded = any(
+            str(d) in ["cpu", "disk"] for d in getattr(model, "hf_device_map", {}).values()
+        )
+
+        # Horizontal fusion is for the HF modules: it is skipped when fuse_layers
+        # replaces them with fused blocks (which build their own QKV projection),
+        # but still runs for models without fused blocks. QUICK weights are
+        # interleaved per matrix and already load as a fused qkv_proj.
+        # Can be disabled for models whose attention/MLP forward does not call
+        # the projections in order on the same input tensor
+        has_fused_blocks = self.fuse_layers is not BaseAWQForCausalLM.fuse_layers
+        if (
+            horizontal_fusion
+            and not (fuse_layers and has_fused_blocks)
+            and not offloaded
+            and quant_config.version != "QUICK"
+        ):
+            self._fuse_horizontal_linears(self, model)
         
         # Dispath to devices
         if fuse_layers:
@@ -352,10 +471,15 @@ class BaseAWQForCausalLM(nn.Module):
             else:
                 ignore_patterns.append("*.safetensors*")
 
-            model_path = snapshot_download(model_path, ignore_patterns=ignore_patterns)
+            # download shards in parallel, huggingface_hub defaults to 8 workers
+            model_path = snapshot_download(
+                model_path,
+                ignore_patterns=ignore_patterns,
+                max_workers=min(16, (os.cpu_count() or 1) * 2),
+            )
 
         if model_filename != "":
-            model_weights_path = model_path + f"/{model_filename}"
+            model_weights_path = os.path.join(model_path, model_filename)
         else:
             model_weights_path = model_path
 
@@ -364,22 +488,19 @@ class BaseAWQForCausalLM(nn.Module):
         quant_config = AwqConfig.from_pretrained(model_path)
 
         # Load model config and set max generation length
+        config = AutoConfig.from_pretrained(
+            model_path, trust_remote_code=trust_remote_code, **config_kwargs
+        )
+
         if max_new_tokens is None and hasattr(self, "max_new_tokens_key"):
-            config = AutoConfig.from_pretrained(
-                model_path, trust_remote_code=trust_remote_code, **config_kwargs
-            )
-            config.max_new_tokens = getattr(config, self.max_new_tokens_key, 2048)
-            # To add the generate support for Multi-modal models as well
-            if hasattr(config, "text_config"):
-                config.text_config.max_new_tokens = getattr(
-                    config, self.max_new_tokens_key, 2048
-                )
-        else:
-            max_new_tokens = 2048 if max_new_tokens is None else max_new_tokens
-            config = AutoConfig.from_pretrained(
-                model_path, trust_remote_code=trust_remote_code, **config_kwargs
-            )
-            config.max_new_tokens = max_new_tokens
+            max_new_tokens = getattr(config, self.max_new_tokens_key, 2048)
+        elif max_new_tokens is None:
+            max_new_tokens = 2048
+
+        config.max_new_tokens = max_new_tokens
+        # To add the generate support for Multi-modal models as well
+        if hasattr(config, "text_config"):
+            config.text_config.max_new_tokens = max_new_tokens
 
         return model_weights_path, config, quant_config
 
@@ -391,23 +512,47 @@ class BaseAWQForCausalLM(nn.Module):
         assert not (
             version == "GEMV" and (use_exllama or use_exllama_v2)
         ), "Exllama kernels only support GEMM version."
+        assert not (
+            use_exllama and use_exllama_v2
+        ), "Only one of use_exllama and use_exllama_v2 can be set."
         print("Kernel Version: ", version)
         # Get blocks of model
         layers = self.get_model_layers(model)
 
+        # Device and kernel choice are the same for every layer,
+        # QUICK has its own kernels and ignores the exllama flags
+        if version == "QUICK":
+            q_linear_module = WQLINEAR_MODULES[(version, False, False)]
+            q_linear_kwargs = QUICK_K_SPLITS.get(torch.cuda.get_device_capability(), {})
+        else:
+            q_linear_module = WQLINEAR_MODULES[(version, use_exllama, use_exllama_v2)]
+            q_linear_kwargs = {}
+
         for i in tqdm(range(len(layers)), desc="Replacing layers..."):
             layer = layers[i]
+            # Resolve before any submodule of the layer gets replaced
+            layer_device = next(layer.parameters()).device
 
             # Replace activation functions
             self._scale_activations(self, layer)
 
             if version == "QUICK":
-                weights = torch.cat([layer.self_attn.q_proj.weight, layer.self_attn.k_proj.weight, layer.self_attn.v_proj.weight], dim=0)
-                bias = torch.cat([layer.self_attn.q_proj.bias, layer.self_attn.k_proj.bias, layer.self_attn.v_proj.bias], dim=0) if layer.self_attn.q_proj.bias is not None else None
-                qkv_layer = nn.Linear(layer.self_attn.q_proj.in_features, layer.self_attn.q_proj.out_features+layer.self_attn.k_proj.out_features+layer.self_attn.v_proj.out_features, layer.self_attn.q_proj.bias is not None, layer.self_attn.q_proj.weight.device)
-
-                qkv_layer.weight.data = weights
-                qkv_layer.bias = bias
+                q_proj, k_proj, v_proj = layer.self_attn.q_proj, layer.self_attn.k_proj, layer.self_attn.v_proj
+                modules_to_not_convert = quant_config.modules_to_not_convert or []
+                if not any(key in "self_attn.qkv_proj" for key in modules_to_not_convert):
+                    # weights come from the checkpoint, so build the quantized qkv_proj
+                    # from the shapes alone instead of fusing fp16 weights first
+                    qkv_layer = q_linear_module(
+                        quant_config.w_bit,
+                        quant_config.q_group_size,
+                        q_proj.in_features,
+                        q_proj.out_features + k_proj.out_features + v_proj.out_features,
+                        q_proj.bias is not None,
+                        layer_device,
+                        **q_linear_kwargs,
+                    )
+                else:
+                    qkv_layer = fuse_qkv_linear(q_proj, k_proj, v_proj)
                 attn = QuantAttentionFused(hidden_size=model.config.hidden_size, n_heads=model.config.num_attention_heads, qkv_layer=qkv_layer, o_proj=layer.self_attn.o_proj, n_kv_heads=model.config.num_key_value_heads,
                                     dev=layer.self_attn.q_proj.weight.device, max_seq_len=model.config.max_new_tokens, rope_theta=model.config.rope_theta) #AttributeError: 'LlamaConfig' object has no attribute 'max_new_tokens'
                 set_op_by_name(layer, 'self_attn', attn)
@@ -419,37 +564,48 @@ class BaseAWQForCausalLM(nn.Module):
             named_linears = exclude_layers_to_not_quantize(
                 named_linears, quant_config.modules_to_not_convert
             )
-            gpu_A100 = False
-            gpu_device = torch.cuda.get_device_name()
-            if 'A100' in gpu_device and 'A1000' not in gpu_device:
-                gpu_A100 = True
-                
+
             # Replace nn.Linear with WQLinear
             for name, module in named_linears.items():
-                if version == "QUICK":
-                    q_linear_module = WQLinear_QUICK
-                elif use_exllama:
-                    q_linear_module = WQLinear_Exllama
-                elif use_exllama_v2:
-                    q_linear_module = WQLinear_ExllamaV2
-                elif version == "GEMM":
-                    q_linear_module = WQLinear_GEMM
-                elif version == "GEMV":
-                    q_linear_module = WQLinear_GEMV
-
-                if version == "QUICK" and gpu_A100:
-                    q_linear = q_linear_module.from_linear(
-                        module, quant_config.w_bit, quant_config.q_group_size, True, k_split_1=16, k_split_2=16
-                    )
-                else:
-                    q_linear = q_linear_module.from_linear(
-                        module, quant_config.w_bit, quant_config.q_group_size, True
-                    )
-                q_linear.to(next(layer.parameters()).device)
+                q_linear = q_linear_module.from_linear(
+                    module, quant_config.w_bit, quant_config.q_group_size, True, **q_linear_kwargs
+                )
+                q_linear.to(layer_device)
                 set_op_by_name(layer, name, q_linear)
 
-            torch.cuda.empty_cache()
-            gc.collect()
+        # Layers are built on empty weights, a single cleanup after the loop is enough
+        torch.cuda.empty_cache()
+        gc.collect()
+
+    @staticmethod
+    def _fuse_horizontal_linears(self, model):
+        fusable_types = (WQLinear_GEMM, WQLinear_GEMV, WQLinear_Exllama, WQLinear_ExllamaV2)
+        layers = self.get_model_layers(model)
+
+        for layer in tqdm(layers, desc="Fusing linears..."):
+            for parent_name, fused_name, linear_names in HORIZONTAL_FUSION_GROUPS:
+                parent = getattr(layer, parent_name, None)
+                linears = [getattr(parent, name, None) for name in linear_names]
+
+                # Only fuse identical quantized linears, e.g. skip modules_to_not_convert
+                if not isinstance(linears[0], fusable_types):
+                    continue
+                if any(
+                    type(linear) is not type(linears[0])
+                    or linear.in_features != linears[0].in_features
+                    or (linear.bias is None) != (linears[0].bias is None)
+                    for linear in linears
+                ):
+                    continue
+
+                # Checkpoints keep the separate linears, fuse after loading them
+                fused_linear = fuse_linears(layer, linears)
+                set_op_by_name(parent, fused_name, fused_linear)
+
+                split_sizes = [linear.out_features for linear in linears]
+                linear_slices = split_fused_linear(fused_linear, linear_names, split_sizes)
+                for name, linear_slice in zip(linear_names, linear_slices):
+                    set_op_by_name(parent, name, linear_slice)
 
     @staticmethod
     def _scale_activations(self, layer):
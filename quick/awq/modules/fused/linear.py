@@ -0,0 +1,82 @@
+import torch
+import functools
+import torch.nn as nn
+from quick.awq.modules.linear.gemv import WQLinear_GEMV
+
+
+class FusedLinearSlice(nn.Module):
+    """
+    Stand-in for one of several linear layers that share the same input and
+    were horizontally fused into a single quantized linear (e.g. q/k/v or
+    gate/up). The fused GEMM runs once per input and every slice returns its
+    share of the output, so the unmodified HF forward keeps working.
+    """
+    def __init__(self, fused_linear, split_sizes, index, cache):
+        super().__init__()
+        # fused_linear is registered on the parent module, keep a plain
+        # reference here so it is not duplicated in the state dict
+        self.__dict__["fused_linear"] = fused_linear
+        self.split_sizes = split_sizes
+        self.index = index
+        self.cache = cache
+        self.in_features = fused_linear.in_features
+        self.out_features = split_sizes[index]
+
+    @torch.no_grad()
+    def forward(self, x):
+        if self.cache.get("input") is not x:
+            self.cache["input"] = x
+            self.cache["outputs"] = torch.split(
+                self.fused_linear(x), self.split_sizes, dim=-1
+            )
+        out = self.cache["outputs"][self.index]
+
+        # the last slice consumed the outputs, drop references to free memory
+        if self.index == len(self.split_sizes) - 1:
+            self.cache.clear()
+
+        return out
+
+    def extra_repr(self) -> str:
+        return "in_features={}, out_features={}, index={}".format(
+            self.in_features, self.out_features, self.index
+        )
+
+
+def split_fused_linear(fused_linear, linear_names, split_sizes):
+    # save the fused tensors under the original per-linear keys so that
+    # checkpoints written after fusion still load through from_quantized
+    fused_linear._register_state_dict_hook(
+        functools.partial(
+            split_state_dict_hook, linear_names=linear_names, split_sizes=split_sizes
+        )
+    )
+
+    cache = {}
+    return [
+        FusedLinearSlice(fused_linear, split_sizes, index, cache)
+        for index in range(len(split_sizes))
+    ]
+
+
+def split_state_dict_hook(module, state_dict, prefix, local_metadata, linear_names, split_sizes):
+    parent_prefix = prefix[: prefix.rstrip(".").rfind(".") + 1]
+    pack_num = 32 // module.w_bit
+
+    for tensor_name in ["qweight", "qzeros", "scales", "bias"]:
+        key = prefix + tensor_name
+        if key not in state_dict:
+            continue
+
+        # GEMV stores output features on dim 0, GEMM/Exllama on dim 1 with
+        # qweight and qzeros packing pack_num output features per int32
+        if tensor_name == "bias" or isinstance(module, WQLinear_GEMV):
+            dim, sizes = 0, split_sizes
+        elif tensor_name == "scales":
+            dim, sizes = 1, split_sizes
+        else:
+            dim, sizes = 1, [size // pack_num for size in split_sizes]
+
+        tensor = state_dict.pop(key)
+        for name, part in zip(linear_names, torch.split(tensor, sizes, dim=dim)):
+            state_dict[f"{parent_prefix}{name}.{tensor_name}"] = part
@@ -20,7 +20,7 @@ from quick.awq.utils.module import (
     set_op_by_name,
     exclude_layers_to_not_quantize
 )
-from quick.awq.utils.fused_utils import get_attention_shapes
+from quick.awq.utils.fused_utils import get_attention_shapes, fuse_qkv_linear
 from quick.awq.modules.fused.cache import WindowedCache
 from quick.awq.modules.fused.attn import RoPE, ALiBi
 
@@ -149,14 +149,8 @@ class AwqQuantizer:
             clear_memory()
 
     def _apply_quant_attn(self, module):
-        
-        weights = torch.cat([module.self_attn.q_proj.weight, module.self_attn.k_proj.weight, module.self_attn.v_proj.weight], dim=0)
-        bias = torch.cat([module.self_attn.q_proj.bias, module.self_attn.k_proj.bias, module.self_attn.v_proj.bias], dim=0) if module.self_attn.q_proj.bias is not None else None
-        qkv_layer = nn.Linear(module.self_attn.q_proj.in_features, module.self_attn.q_proj.out_features+module.self_attn.k_proj.out_features+module.self_attn.v_proj.out_features, module.self_attn.q_proj.bias is not None, module.self_attn.q_proj.weight.device)
-        
-        qkv_layer.weight.data = weights
-        qkv_layer.bias = bias
-        
+        qkv_layer = fuse_qkv_linear(module.self_attn.q_proj, module.self_attn.k_proj, module.self_attn.v_proj)
+
         attn = QuantAttentionFused(hidden_size=self.model.config.hidden_size, n_heads=self.model.config.num_attention_heads, qkv_layer=qkv_layer, o_proj=module.self_attn.o_proj, n_kv_heads=self.model.config.num_key_value_heads,
                                     dev=module.self_attn.q_proj.weight.device, max_seq_len=4096, rope_theta=self.model.config.rope_theta) # 'max_seq_len' is to be fixed
 
@@ -316,7 +310,7 @@ class AwqQuantizer:
         
         return clip_list
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def _compute_best_clip(self, w: torch.Tensor, input_feat: torch.Tensor, n_grid=20, max_shrink=0.5, n_sample_token=512):
         assert w.dim() == 2
         org_w_shape = w.shape
@@ -1,4 +1,6 @@
 import torch
+import torch.nn as nn
+from torch.nn.utils import skip_init
 from quick.awq.modules.linear.quick import WQLinear_QUICK
 from quick.awq.modules.linear.gemm import WQLinear_GEMM
 from quick.awq.modules.linear.gemv import WQLinear_GEMV
@@ -51,47 +53,67 @@ def prepare_attention_mask(seqlen, start_pos, device, type_as: torch.Tensor):
     return mask
 
 def fuse_qkv(module, q_proj, k_proj, v_proj):
-    bias = torch.cat([q_proj.bias, k_proj.bias, v_proj.bias], dim=0) if q_proj.bias is not None else None
+    return fuse_linears(module, [q_proj, k_proj, v_proj])
 
-    if isinstance(q_proj, WQLinear_QUICK):
+def fuse_linears(module, linears):
+    first = linears[0]
+    bias = torch.cat([linear.bias for linear in linears], dim=0) if first.bias is not None else None
+
+    if isinstance(first, WQLinear_QUICK):
         q_linear = WQLinear_QUICK
-    elif isinstance(q_proj, WQLinear_GEMV):
+    elif isinstance(first, WQLinear_GEMV):
         q_linear = WQLinear_GEMV
-    elif isinstance(q_proj, WQLinear_GEMM):
+    elif isinstance(first, WQLinear_GEMM):
         q_linear = WQLinear_GEMM
-    elif isinstance(q_proj, WQLinear_Exllama):
+    elif isinstance(first, WQLinear_Exllama):
         q_linear = WQLinear_Exllama
     else:
         q_linear = WQLinear_ExllamaV2
 
-    qkv_layer = q_linear(
-        q_proj.w_bit,
-        q_proj.group_size,
+    fused_layer = q_linear(
+        first.w_bit,
+        first.group_size,
+        first.in_features,
+        sum(linear.out_features for linear in linears),
+        first.bias is not None,
+        next(iter(module.state_dict().values())).device
+    )
+
+    if isinstance(first, WQLinear_GEMV):
+        fused_layer.qweight = torch.cat([linear.qweight for linear in linears], dim=0)
+        fused_layer.qzeros = torch.cat([linear.qzeros for linear in linears], dim=0)
+        fused_layer.scales = torch.cat([linear.scales for linear in linears], dim=0)
+        fused_layer.split_k_iters = first.split_k_iters
+    elif isinstance(first, (WQLinear_GEMM, WQLinear_Exllama, WQLinear_ExllamaV2)):
+        fused_layer.qweight = torch.cat([linear.qweight for linear in linears], dim=1)
+        fused_layer.qzeros = torch.cat([linear.qzeros for linear in linears], dim=1)
+        fused_layer.scales = torch.cat([linear.scales for linear in linears], dim=1)
+    
+    fused_layer.bias = bias
+
+    return fused_layer
+
+@torch.no_grad()
+def fuse_qkv_linear(q_proj, k_proj, v_proj):
+    # unquantized counterpart of fuse_qkv, slices are copied straight into
+    # the fused weight instead of going through a torch.cat buffer. Every
+    # element gets overwritten, so skip the default parameter init.
+    qkv_layer = skip_init(
+        nn.Linear,
         q_proj.in_features,
         q_proj.out_features + k_proj.out_features + v_proj.out_features,
         q_proj.bias is not None,
-        next(iter(module.state_dict().values())).device
+        device=q_proj.weight.device,
+        dtype=q_proj.weight.dtype,
     )
 
-    if isinstance(q_proj, WQLinear_GEMV):
-        qkv_layer.qweight = torch.cat([q_proj.qweight, k_proj.qweight, v_proj.qweight], dim=0)
-        qkv_layer.qzeros = torch.cat([q_proj.qzeros, k_proj.qzeros, v_proj.qzeros], dim=0)
-        qkv_layer.scales = torch.cat([q_proj.scales, k_proj.scales, v_proj.scales], dim=0)
-        qkv_layer.split_k_iters = q_proj.split_k_iters
-    elif isinstance(q_proj, WQLinear_GEMM):
-        qkv_layer.qweight = torch.cat([q_proj.qweight, k_proj.qweight, v_proj.qweight], dim=1)
-        qkv_layer.qzeros = torch.cat([q_proj.qzeros, k_proj.qzeros, v_proj.qzeros], dim=1)
-        qkv_layer.scales = torch.cat([q_proj.scales, k_proj.scales, v_proj.scales], dim=1)
-    elif isinstance(q_proj, WQLinear_Exllama):
-        qkv_layer.qweight = torch.cat([q_proj.qweight, k_proj.qweight, v_proj.qweight], dim=1)
-        qkv_layer.qzeros = torch.cat([q_proj.qzeros, k_proj.qzeros, v_proj.qzeros], dim=1)
-        qkv_layer.scales = torch.cat([q_proj.scales, k_proj.scales, v_proj.scales], dim=1)
-    elif isinstance(q_proj, WQLinear_ExllamaV2):
-        qkv_layer.qweight = torch.cat([q_proj.qweight, k_proj.qweight, v_proj.qweight], dim=1)
-        qkv_layer.qzeros = torch.cat([q_proj.qzeros, k_proj.qzeros, v_proj.qzeros], dim=1)
-        qkv_layer.scales = torch.cat([q_proj.scales, k_proj.scales, v_proj.scales], dim=1)
-    
-    qkv_layer.bias = bias
+    start = 0
+    for linear in [q_proj, k_proj, v_proj]:
+        end = start + linear.out_features
+        qkv_layer.weight[start:end].copy_(linear.weight, non_blocking=True)
+        if linear.bias is not None:
+            qkv_layer.bias[start:end].copy_(linear.bias, non_blocking=True)
+        start = end
 
     return qkv_layer
 
@@ -6,7 +6,10 @@ AWQ_REVERSE_ORDER = [0, 4, 1, 5, 2, 6, 3, 7]
 
 
 def unpack_awq(qweight: torch.Tensor, qzeros: torch.Tensor, bits: int):
+    # shift in AWQ_REVERSE_ORDER to unpack straight into logical column order,
+    # e.g. for 4 bits [0, 4, ..., 28] -> [0, 16, 4, 20, 8, 24, 12, 28]
     shifts = torch.arange(0, 32, bits, device=qzeros.device)
+    shifts = shifts.view(2, -1).t().reshape(-1)
 
     # unpacking columnwise
     iweights = torch.bitwise_right_shift(qweight[:, :, None], shifts[None, None, :]).to(
@@ -23,22 +26,6 @@ def unpack_awq(qweight: torch.Tensor, qzeros: torch.Tensor, bits: int):
     return iweights, izeros
 
 
-def reverse_awq_order(iweights: torch.Tensor, izeros: torch.Tensor, bits: int):
-    reverse_order_tensor = torch.arange(
-        izeros.shape[-1],
-        dtype=torch.int32,
-        device=izeros.device,
-    )
-    reverse_order_tensor = reverse_order_tensor.view(-1, 32 // bits)
-    reverse_order_tensor = reverse_order_tensor[:, AWQ_REVERSE_ORDER]
-    reverse_order_tensor = reverse_order_tensor.view(-1)
-
-    izeros = izeros[:, reverse_order_tensor]
-    iweights = iweights[:, reverse_order_tensor]
-
-    return iweights, izeros
-
-
 def pack_exllama(iweights: torch.Tensor, izeros: torch.Tensor, bits: int):
     shifts = torch.arange(0, 32, bits, device=iweights.device)
 
@@ -62,10 +49,8 @@ def pack_exllama(iweights: torch.Tensor, izeros: torch.Tensor, bits: int):
 
 
 def unpack_reorder_pack(qweight, qzeros, bits):
-    # Unpack the qweight and qzeros tensors
+    # Unpack the qweight and qzeros tensors in logical column order
     iweight, izeros = unpack_awq(qweight, qzeros, bits)
-    # Reverse the order of the iweight and izeros tensors
-    iweight, izeros = reverse_awq_order(iweight, izeros, bits)
 
     # overflow checks
     iweight = torch.bitwise_and(iweight, (2**bits) - 1)
@@ -80,10 +65,8 @@ def unpack_reorder_pack(qweight, qzeros, bits):
     return qweight, qzeros
 
 def dequantize_gemm(qweight, qzeros, scales, bits, group_size):
-    # Unpack the qweight and qzeros tensors
+    # Unpack the qweight and qzeros tensors in logical column order
     iweight, izeros = unpack_awq(qweight, qzeros, bits)
-    # Reverse the order of the iweight and izeros tensors
-    iweight, izeros = reverse_awq_order(iweight, izeros, bits)
 
     # overflow checks
     iweight = torch.bitwise_and(iweight, (2**bits) - 1)